@@ -1,40 +1,38 @@
 """Calibration scripts for University of Glasgow Observatory magnetometer"""
 
+import numpy as np
+
 # conversion factors for each channel
 CONVERSION = []
 
-def set_conversion(factors):
-    global CONVERSION
+# wire resistance between magnetometer and A/D
+R_WIRES = 2.48
 
-    CONVERSION = list(factors)
+# input resistance seen by signal
+R_IN = 10000
 
-def scale_counts_to_volts(sample_values):
-    return [int(sample) * factor
-            for sample, factor in zip(sample_values, CONVERSION)]
+# potential divider fraction for up-down field
+POT_DIV_FRACTION = 3.01 / (6.98 + 3.01)
 
-def scale_volts_to_nt_and_degrees(sample_values):
-    """Scales voltages from magnetometer to nanotesla and degrees
+# nanotesla per volt scale
+B_SCALE = 1e6 / 143
 
-    Based on Matlab code by Hugh Potts.
-    """
-
-    if len(sample_values) is not 4:
-        raise Exception("There must be 4 samples specified")
+# temperature sensor degrees per volt, based on LM35's 10mV / degC
+T_SCALE = 100
 
-    # wire resistance between magnetometer and A/D
-    r_wires = 2.48
+# derived factors
+_WIRE_FACTOR = 1 + R_WIRES / R_IN
+_CROSSTALK = R_WIRES / R_IN
+_INV_POT_DIV = 1 / POT_DIV_FRACTION
 
-    # input resistance seen by signal
-    r_in = 10000
+def _calibration_matrix():
+    """Build the matrix mapping measured voltages to nanotesla and degrees
 
-    # potential divider fraction for up-down field
-    pot_div_fraction = 3.01 / (6.98 + 3.01)
-
-    # nanotesla per volt scale
-    b_scale = 1e6 / 143
+    Based on Matlab code by Hugh Potts.
 
-    # temperature sensor degrees per volt, based on LM35's 10mV / degC
-    t_scale = 100
+    The whole voltage to physical unit transformation is linear, so it is
+    expressed as a single 4×4 matrix which is applied to each reading.
+    """
 
     ###
     # Scale voltages to nanotesla.
@@ -45,27 +43,105 @@ def scale_volts_to_nt_and_degrees(sample_values):
     #
     # v_true = v_measured(1 + r_wires / r_in) + sum(v_measured) * r_wires / r_in
 
-    # first we need to multiply up the z channel (3th item in list) to its true
+    # first we need to multiply up the z channel (3rd item in list) to its true
     # value
-    sample_values[2] = sample_values[2] / pot_div_fraction
+    pot_div = np.diag([1, 1, _INV_POT_DIV, 1])
+
+    # channel voltage and crosstalk correction
+    crosstalk = _WIRE_FACTOR * np.eye(4) + _CROSSTALK * np.ones((4, 4))
+
+    # conversion to physical units
+    units = np.diag([B_SCALE, B_SCALE, B_SCALE, T_SCALE])
+
+    return units @ crosstalk @ pot_div
+
+# voltage to physical unit transformation
+_CAL_MATRIX = _calibration_matrix()
+
+# count to physical unit transformation, available once conversion is set
+_COUNTS_MATRIX = None
+
+def set_conversion(factors):
+    """Sets the conversion factors from counts to volts for each channel
+
+    :param factors: volts per count for each channel, in channel order
+    :type factors: iterable of 4 floats
+    :raises ValueError: if there are not 4 factors
+    """
+
+    global CONVERSION, _COUNTS_MATRIX
+
+    factors = list(factors)
+
+    if len(factors) != 4:
+        raise ValueError("There must be 4 conversion factors specified")
 
-    # sum up measured voltages
-    v_measured_sum = sum(sample_values)
+    CONVERSION = factors
 
-    # channel voltage correction factor
-    v_measured_correction = v_measured_sum * r_wires / r_in
+    # fold the per-channel scaling into the calibration matrix
+    _COUNTS_MATRIX = _CAL_MATRIX * np.asarray(CONVERSION, dtype=np.float64)
 
-    # sample correction
-    v_sample_correction = [value * (1 + r_wires / r_in)
-                           for value in sample_values]
+def scale_counts_to_volts(sample_values):
+    return [int(sample) * factor
+            for sample, factor in zip(sample_values, CONVERSION)]
+
+def scale_counts_to_nt_and_degrees(sample_values):
+    """Scales counts from magnetometer to nanotesla and degrees
+
+    Equivalent to :func:`scale_counts_to_volts` followed by
+    :func:`scale_volts_to_nt_and_degrees`, in a single matrix product.
+
+    :param sample_values: counts for a single reading
+    :type sample_values: sequence of 4 numbers
+    :return: calibrated values
+    :rtype: :class:`numpy.ndarray`
+    :raises ValueError: if conversion factors are not set or there are not 4 \
+    samples
+    """
+
+    if _COUNTS_MATRIX is None:
+        raise ValueError("Conversion factors have not been set")
+
+    sample_values = np.asarray(sample_values, dtype=np.float64)
+
+    if sample_values.shape != (4,):
+        raise ValueError("There must be 4 samples specified")
+
+    # return calibrated values
+    return _COUNTS_MATRIX @ sample_values
+
+def scale_volts_to_nt_and_degrees(sample_values):
+    """Scales voltages from magnetometer to nanotesla and degrees
+
+    :param sample_values: voltages for a single reading
+    :type sample_values: sequence of 4 floats
+    :return: calibrated values
+    :rtype: :class:`numpy.ndarray`
+    :raises ValueError: if there are not 4 samples
+    """
+
+    sample_values = np.asarray(sample_values, dtype=np.float64)
+
+    if sample_values.shape != (4,):
+        raise ValueError("There must be 4 samples specified")
+
+    # return calibrated values
+    return _CAL_MATRIX @ sample_values
+
+def scale_volts_to_nt_and_degrees_batch(readings):
+    """Scales a block of voltages from magnetometer to nanotesla and degrees
+
+    :param readings: voltages, one reading per row
+    :type readings: array-like of shape (N, 4)
+    :return: calibrated values, one reading per row
+    :rtype: :class:`numpy.ndarray`
+    :raises ValueError: if readings do not each contain 4 samples
+    """
 
-    # corrected voltages
-    v_corrected = [v_sample + v_measured_correction
-                   for v_sample in v_sample_correction]
+    readings = np.asarray(readings, dtype=np.float64)
 
-    # now convert to physical units
-    v_corrected[0:3] = [v * b_scale for v in v_corrected[0:3]]
-    v_corrected[3] = v_corrected[3] * t_scale
+    if readings.ndim != 2 or readings.shape[-1] != 4:
+        raise ValueError("There must be 4 samples specified per reading")
 
     # return calibrated values
-    return v_corrected
+    return readings @ _CAL_MATRIX.T
@@ -1,9 +1,11 @@
 """Configuration parser and defaults"""
 
+import os
 import os.path
 import abc
 import logging
-import abc
+import pickle
+import hashlib
 from configparser import RawConfigParser
 import pkg_resources
 import appdirs
@@ -11,21 +13,187 @@ import appdirs
 # logger
 logger = logging.getLogger("config")
 
+# config file paths, keyed by config filename
+_CONFIG_FILEPATHS = {}
+
+# loaded config instances, keyed by config class
+_CONFIG_INSTANCES = {}
+
 class BaseConfig(RawConfigParser, metaclass=abc.ABCMeta):
     CONFIG_FILENAME = None
     DEFAULT_CONFIG_FILENAME = None
 
+    # size of the SHA-256 digest stored at the start of the cache file
+    CACHE_DIGEST_SIZE = 32
+
+    def __new__(cls, *args, **kwargs):
+        # reuse the existing instance unless its config file has changed
+        instance = _CONFIG_INSTANCES.get(cls)
+
+        if instance is None or not instance.is_current():
+            instance = super(BaseConfig, cls).__new__(cls)
+            _CONFIG_INSTANCES[cls] = instance
+
+        return instance
+
     def __init__(self, *args, **kwargs):
+        if hasattr(self, "_src_signature"):
+            # reused instance, already loaded
+            return
+
         super(BaseConfig, self).__init__(*args, **kwargs)
 
         self.load_config_file()
 
+    def is_current(self):
+        """Check if the loaded config is up to date with the config file
+
+        :return: whether the config file is unchanged since it was loaded
+        :rtype: bool
+        """
+
+        try:
+            signature = self.file_signature(self.get_config_filepath())
+        except OSError:
+            return False
+
+        return signature == getattr(self, "_src_signature", None)
+
     def load_config_file(self):
         path = self.get_config_filepath()
+        cache_path = self.get_cache_filepath()
+        signature = self.file_signature(path)
+
+        # use previously parsed values if the config file hasn't changed
+        if not self.load_cache_file(cache_path, signature):
+            with open(path) as obj:
+                logger.debug("Reading config from %s", path)
+                self.read_file(obj)
+
+            self.save_cache_file(cache_path, signature)
+
+        self._src_signature = signature
+
+    @staticmethod
+    def file_signature(path):
+        """Get values identifying the current version of a file
+
+        The size and inode are included along with the modification time so
+        that a file replaced with one carrying the same modification time (such
+        as with `cp -p` or `rsync -a`) is still detected as changed.
+
+        :param path: file path
+        :type path: str
+        :return: modification time in ns, size and inode
+        :rtype: tuple
+        :raises OSError: if the file cannot be accessed
+        """
+
+        stat = os.stat(path)
+
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def load_cache_file(self, cache_path, signature):
+        """Load parsed config from the cache file
+
+        :param cache_path: cache file path
+        :type cache_path: str
+        :param signature: config file signature from :meth:`file_signature`
+        :type signature: tuple
+        :return: whether the cache was valid and loaded
+        :rtype: bool
+        """
+
+        try:
+            with open(cache_path, 'rb') as obj:
+                data = obj.read()
+
+            # the pickle is preceded by its digest, so damage is detected
+            # before anything is unpickled
+            digest = data[:self.CACHE_DIGEST_SIZE]
+            payload = data[self.CACHE_DIGEST_SIZE:]
+
+            if hashlib.sha256(payload).digest() != digest:
+                raise ValueError("cache digest does not match")
 
-        with open(path) as obj:
-            logger.debug("Reading config from %s", path)
-            self.read_file(obj)
+            cache = pickle.loads(payload)
+
+            if cache["signature"] != signature:
+                # config file has changed since it was cached
+                return False
+
+            sections = cache["sections"]
+
+            if not isinstance(sections, dict) or not all(
+                isinstance(values, dict) for values in sections.values()):
+                raise TypeError("cached sections are not a dict of dicts")
+
+            logger.debug("Reading cached config from %s", cache_path)
+            self.read_dict(sections)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            # a damaged cache must not stop the config from loading, so discard
+            # anything it partly applied and fall back to the config file
+            logger.debug("Ignoring invalid config cache %s: %r", cache_path, e)
+            self.clear_config()
+
+            return False
+
+        return True
+
+    def clear_config(self):
+        """Remove all sections and defaults"""
+
+        for section in self.sections():
+            self.remove_section(section)
+
+        self.defaults().clear()
+
+    def save_cache_file(self, cache_path, signature):
+        """Save parsed config to the cache file
+
+        The cache is written to a temporary file first and then moved into
+        place, so other processes never see a partially written cache. It is
+        only readable by the current user since it contains the config's
+        passwords.
+
+        :param cache_path: cache file path
+        :type cache_path: str
+        :param signature: config file signature from :meth:`file_signature`
+        :type signature: tuple
+        """
+
+        sections = {self.default_section: dict(self.defaults())}
+        sections.update({section: dict(self._sections[section])
+                         for section in self.sections()})
+
+        cache = {"signature": signature, "sections": sections}
+        temp_path = cache_path + ".tmp"
+
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+
+            with os.fdopen(fd, 'wb') as obj:
+                # restrict an existing temporary file too
+                os.fchmod(fd, 0o600)
+
+                payload = pickle.dumps(cache)
+                obj.write(hashlib.sha256(payload).digest())
+                obj.write(payload)
+
+                # make sure the cache is on disk before it replaces the old one,
+                # so a power cut can't leave an empty or partial cache behind
+                obj.flush()
+                os.fsync(fd)
+
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            # caching is only an optimisation
+            logger.debug("Cannot write config cache to %s: %s", cache_path, e)
 
     @classmethod
     def get_config_filepath(cls):
@@ -35,6 +203,9 @@ class BaseConfig(RawConfigParser, metaclass=abc.ABCMeta):
         template.
         """
 
+        if cls.CONFIG_FILENAME in _CONFIG_FILEPATHS:
+            return _CONFIG_FILEPATHS[cls.CONFIG_FILENAME]
+
         config_dir = appdirs.user_config_dir("magnetometer")
         config_file = os.path.join(config_dir, cls.CONFIG_FILENAME)
 
@@ -42,8 +213,18 @@ class BaseConfig(RawConfigParser, metaclass=abc.ABCMeta):
         if not os.path.isfile(config_file):
             cls.create_user_config_file(config_file)
 
+        _CONFIG_FILEPATHS[cls.CONFIG_FILENAME] = config_file
+
         return config_file
 
+    @classmethod
+    def get_cache_filepath(cls):
+        """Find the path to the parsed config cache file"""
+
+        cache_dir = appdirs.user_cache_dir("magnetometer")
+
+        return os.path.join(cache_dir, cls.CONFIG_FILENAME + ".pickle")
+
     @classmethod
     def create_user_config_file(cls, config_file):
         """Create config file in user directory"""
@@ -51,8 +232,7 @@ class BaseConfig(RawConfigParser, metaclass=abc.ABCMeta):
         directory = os.path.dirname(config_file)
 
         # create user config directory
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+        os.makedirs(directory, exist_ok=True)
 
         logger.debug("Creating config file at %s", directory)
 
@@ -1,16 +1,20 @@
 """University of Glasgow magnetometer FTP functionality"""
 
 import sys
+import os
 import os.path
 import time
 import datetime
+import gzip
+import json
+import itertools
 import logging
 from logging.handlers import TimedRotatingFileHandler
-from threading import Thread, Timer
+from threading import Thread, Timer, Event
+from concurrent.futures import ThreadPoolExecutor
 import signal
 import configparser
-import glob
-from urllib.request import urlopen
+from http.client import HTTPConnection, HTTPException
 from ftpsync.targets import FsTarget
 from ftpsync.ftp_target import FtpTarget
 from ftpsync.synchronizers import DownloadSynchronizer, UploadSynchronizer
@@ -44,6 +48,11 @@ root_logger.setLevel(logging.getLevelName(CONF["logging"]["level"].upper()))
 # get logger for FTP
 logger = logging.getLogger("ftp")
 
+def now_ms():
+    """Current timestamp in milliseconds"""
+
+    return int(round(time.time() * 1000))
+
 def run():
     """Start FTP pipe"""
 
@@ -53,11 +62,9 @@ def run():
     pipe = FtpPipe()
 
     def stop(*args):
-        # stop the thread and wait until it finishes
+        # only ask the thread to stop; waiting for it happens below, outside
+        # the signal handler
         pipe.stop()
-        logger.info("Waiting for FTP pipe to stop")
-        pipe.join()
-        logger.info("FTP pipe stopped")
 
     # catch signals
     signal.signal(signal.SIGINT, stop)
@@ -66,9 +73,7 @@ def run():
     # run
     pipe.start()
 
-def stop():
-    pipe.stop()
-    logger.info("Waiting for FTP pipe to stop")
+    # wait until the thread finishes after being stopped
     pipe.join()
     logger.info("FTP pipe stopped")
 
@@ -76,8 +81,25 @@ class FtpPipe(Thread):
     """Client to pipe data from the magnetometer server to a remote FTP server"""
 
     FILE_DATE_FORMAT = "%Y-%m-%d"
+    # equivalent of FILE_DATE_FORMAT for str.format, avoiding strftime
+    FILE_DATE_TEMPLATE = "{0.year:04d}-{0.month:02d}-{0.day:02d}"
     FILE_EXTENSION = "txt"
 
+    # minimum and maximum delay between failed upload attempts, in ms; the
+    # minimum is the default poll time, so short poll times don't retry an
+    # unavailable FTP server many times a second
+    MIN_UPLOAD_BACKOFF = 60 * 1000
+    MAX_UPLOAD_BACKOFF = 60 * 60 * 1000
+
+    # milliseconds in a day
+    MS_PER_DAY = 24 * 60 * 60 * 1000
+
+    # initial number of bytes read from the end of a file to find its last line
+    TAIL_READ_SIZE = 4096
+
+    # maximum time between forcing appended readings to disk, in ms
+    DATA_SYNC_INTERVAL = 60 * 1000
+
     def __init__(self):
         """Initialises the FTP pipe"""
 
@@ -87,68 +109,116 @@ class FtpPipe(Thread):
         # time in ms between polls
         poll_time = int(CONF["ftp"]["poll_time"])
 
-        if poll_time < 1000:
-            # since the runner sleeps for 1s between checks, times less than
-            # 1 second aren't supported
-            raise ValueError("Poll times less than 1000 ms aren't supported")
+        if poll_time <= 0:
+            raise ValueError("Poll time must be positive")
 
         self.poll_time = poll_time
         logger.info("Poll time: {0:.2f} ms".format(self.poll_time))
 
+        # local data directory
+        self.local_dir = CONF["ftp"]["local_dir"]
+
+        # number of files to keep
+        self.max_old_files = int(CONF["ftp"]["max_old_files"])
+
+        if self.max_old_files < 2:
+            raise ValueError("max_old_files must be >= 2")
+
+        # FTP server settings
+        self.remote_target_options = {
+            "path": CONF["ftp"]["remote_dir"],
+            "host": CONF["ftp"]["host"],
+            "port": int(CONF["ftp"]["port"]),
+            "username": CONF["ftp"]["username"],
+            "password": CONF["ftp"]["password"],
+            "timeout": int(CONF["ftp"]["timeout"])
+        }
+
+        # magnetometer server connection, reused between polls when the server
+        # keeps it alive
+        self.server_connection = HTTPConnection(
+            CONF["server"]["host"], int(CONF["server"]["port"]),
+            timeout=float(CONF["server"]["timeout"]))
+
         # default start time
         self.start_time = None
 
-        # retrieval flag
-        self.retrieving = False
+        # timestamp of the latest stored reading, in ms
+        self.latest_timestamp = None
+
+        # UTC date old files were last removed
+        self.last_cleanup_date = None
+
+        # data file kept open for appending, and its path
+        self.data_file = None
+        self.data_file_path_open = None
+
+        # time the open data file was last forced to disk
+        self.last_sync_time = None
+
+        # background FTP uploader, and its latest upload
+        self.upload_executor = ThreadPoolExecutor(max_workers=1)
+        self.pending_upload = None
+
+        # whether local readings need uploading
+        self.upload_required = False
+
+        # delay after failed uploads in ms, and the number of polls still to
+        # skip before the next attempt
+        self.upload_backoff = 0
+        self.upload_skip_polls = 0
+
+        # set when the pipe is asked to stop
+        self.stop_event = Event()
 
     def run(self):
         """Starts piping magnetometer data"""
 
-        # set status on
-        self.retrieving = True
-
         # create local directory if it doesn't exist
-        if not os.path.exists(CONF["ftp"]["local_dir"]):
-            logger.debug("Creating local directory %s",
-                         CONF["ftp"]["local_dir"])
-            os.makedirs(CONF["ftp"]["local_dir"])
+        if not os.path.isdir(self.local_dir):
+            logger.debug("Creating local directory %s", self.local_dir)
+            os.makedirs(self.local_dir, exist_ok=True)
 
         # download today's file from FTP
         logger.debug("Downloading today's data file from FTP server")
         self.sync_from_server()
 
+        # find the latest reading already stored; after this, it's tracked as
+        # new readings are stored
+        self.latest_timestamp = self.latest_recorded_timestamp()
+
         # next poll time is now plus the poll time (in ms)
-        next_poll_time = int(round(time.time() * 1000)) + self.poll_time
+        next_poll_time = now_ms() + self.poll_time
 
         logger.debug("Starting retrieval")
 
-        # main run loop
-        while self.retrieving:
-            # current timestamp in ms
-            now = int(round(time.time() * 1000))
+        try:
+            # main run loop
+            while not self.stop_event.is_set():
+                # current timestamp in ms
+                now = now_ms()
+
+                # wait until the next poll, waking immediately if asked to stop
+                if self.stop_event.wait(max(0, next_poll_time - now) / 1000):
+                    break
 
-            if now < next_poll_time:
-                # sleep, but not for too long so that the thread exits quickly
-                # when asked
-                time.sleep(1)
-            else:
                 self.process_records()
 
                 # update next poll time
                 next_poll_time += self.poll_time
+        finally:
+            # let any upload in progress finish, even if polling failed
+            self.upload_executor.shutdown(wait=True)
+
+            self.close_data_file()
 
     @property
     def local_target(self):
-        return FsTarget(CONF["ftp"]["local_dir"])
+        return FsTarget(self.local_dir)
 
     @property
     def remote_target(self):
-        return FtpTarget(path=CONF["ftp"]["remote_dir"],
-                         host=CONF["ftp"]["host"],
-                         port=int(CONF["ftp"]["port"]),
-                         username=CONF["ftp"]["username"],
-                         password=CONF["ftp"]["password"],
-                         timeout=int(CONF["ftp"]["timeout"]))
+        return FtpTarget(**self.remote_target_options)
 
     def sync_from_server(self):
         """Sync today's readings from FTP server
@@ -198,112 +268,241 @@ class FtpPipe(Thread):
         ftp_uploader.run()
 
     def process_records(self):
-        # timestamp corresponding to last recorded measurement
-        pivot_timestamp = self.latest_recorded_timestamp()
+        if self.latest_timestamp is None:
+            # timestamp corresponding to last recorded measurement
+            self.latest_timestamp = self.latest_recorded_timestamp()
 
         # get readings since last time records were stored
-        latest_data = self.next_readings(pivot_timestamp)
+        latest_data = self.next_readings(self.latest_timestamp)
 
         # check if there are new readings to store
         if latest_data.num_readings:
-            # get readings grouped into days
-            groups = latest_data.get_datetime_grouped_readings()
+            # readings are in time order, so they can be grouped into UTC
+            # days in a single pass
+            for day, readings in itertools.groupby(latest_data.readings,
+                                                   key=self.reading_day):
+                # midnight at the start of this day
+                midnight = datetime.datetime.utcfromtimestamp(
+                    day * self.MS_PER_DAY / 1000)
 
-            # loop over each day
-            for current_date in sorted(groups):
                 # this date's full data file path
-                current_file_path = self.path_from_date(current_date)
+                current_file_path = self.path_from_date(midnight)
 
-                self.store_readings(current_file_path, groups[current_date],
-                                    self.midnight_date(current_date))
+                self.store_readings(current_file_path, list(readings),
+                                    midnight)
 
-            # upload latest version of the file
-            logger.debug("Uploading new readings to FTP server")
-            try:
-                self.sync_to_server()
-            except Exception as e:
-                # do nothing; try again next time
-                # this prevents FTP comms issues from killing the thread
-                logger.error("Failed to upload data to FTP server: %s (will "
-                             "try again)", e)
+            self.latest_timestamp = latest_data.readings[-1].reading_time
+
+            # latest version of the file needs uploading
+            self.upload_required = True
         else:
             logger.debug("No data retrieved from server")
 
-        # clean up old files
-        self.remove_old_files()
+        # upload new readings, or retry a failed upload
+        self.start_upload()
+
+        # clean up old files, once per day since files are daily
+        today = datetime.datetime.utcnow().date()
+
+        if today != self.last_cleanup_date:
+            self.remove_old_files()
+            self.last_cleanup_date = today
+
+    def start_upload(self):
+        """Starts uploading local readings to the FTP server, if required
+
+        The upload runs in the background so that the next poll isn't delayed
+        by FTP latency. Only one upload runs at a time: if the previous one is
+        still in progress, this waits for it to finish first. After a failed
+        upload, enough polls are skipped to cover the retry backoff.
+        """
+
+        if self.pending_upload is not None:
+            if not self.pending_upload.result():
+                # the failed upload's readings still need uploading
+                self.upload_required = True
+
+            self.pending_upload = None
+
+        if not self.upload_required:
+            return
+
+        if self.upload_skip_polls > 0:
+            self.upload_skip_polls -= 1
+            logger.debug("Waiting to retry upload to FTP server")
+            return
+
+        logger.debug("Uploading new readings to FTP server")
+        self.upload_required = False
+        self.pending_upload = self.upload_executor.submit(self.upload)
+
+    def upload(self):
+        """Uploads local readings to the FTP server
+
+        :return: whether the upload succeeded
+        :rtype: bool
+        """
+
+        try:
+            self.sync_to_server()
+        except Exception as e:
+            # try again later; this prevents FTP comms issues from killing the
+            # thread
+            # double the wait after each consecutive failure so that an
+            # unavailable server isn't contacted on every poll
+            self.upload_backoff = min(max(self.MIN_UPLOAD_BACKOFF,
+                                          2 * self.upload_backoff),
+                                      self.MAX_UPLOAD_BACKOFF)
+
+            # uploads only start on a poll, so wait whole polls; counting them
+            # instead of comparing clock times avoids a poll landing just
+            # before the deadline and adding a poll to every wait
+            retry_polls = -(-self.upload_backoff // self.poll_time)
+            self.upload_skip_polls = retry_polls - 1
+
+            logger.error("Failed to upload data to FTP server: %s (will "
+                         "try again in %i ms)", e,
+                         retry_polls * self.poll_time)
+
+            return False
+
+        # reset backoff
+        self.upload_backoff = 0
+        self.upload_skip_polls = 0
+
+        return True
 
     def stop(self):
         """Stops the FTP pipe"""
 
         # stop retrieving data
-        self.retrieving = False
+        self.stop_event.set()
 
     def latest_recorded_timestamp(self):
+        # avoid debug logging overhead inside the loop when it's disabled
+        debug = logger.isEnabledFor(logging.DEBUG)
+
         # search for previous reading in reverse chronological order
         logger.debug("Searching for latest recorded reading")
+        # data_file_walk only returns regular files, so there's no need to
+        # check each path again
         for file_path in self.data_file_walk():
-            if os.path.isfile(file_path):
-                # filename without directory path
-                filename = os.path.basename(file_path)
+            # filename without directory path
+            filename = os.path.basename(file_path)
 
-                # look for reading
+            # look for reading
+            if debug:
                 logger.debug("Searching %s", filename)
-                latest_line = self.latest_line(file_path)
-
-                if latest_line:
-                    logger.debug("Found latest reading in %s", filename)
+            latest_line = self.latest_line(file_path)
 
-                    # filename without extension
-                    file_date = os.path.splitext(filename)[0]
+            if latest_line:
+                logger.debug("Found latest reading in %s", filename)
 
-                    # date equivalent to filename
-                    midnight_date = datetime.datetime.strptime(filename,
-                        self.date_file_format())
+                # date equivalent to filename
+                midnight_date = self.date_from_filename(filename)
 
-                    # milliseconds since midnight
-                    line_ms = int(latest_line.split()[0])
+                # milliseconds since midnight
+                line_ms = int(latest_line.split()[0])
 
-                    # pivot time as midnight timestamp plus reading time, both
-                    # in milliseconds
-                    return int(midnight_date.timestamp() * 1000) + line_ms
+                # pivot time as midnight timestamp plus reading time, both in
+                # milliseconds
+                return int(midnight_date.timestamp() * 1000) + line_ms
 
         logger.debug("Failed to find latest recorded reading")
         return 0
 
-    @staticmethod
-    def store_readings(filepath, readings, midnight):
-        if not os.path.isfile(filepath):
-            logger.debug("Creating %s", filepath)
+    def store_readings(self, filepath, readings, midnight):
+        if filepath != self.data_file_path_open:
+            # readings are for a different file than the one currently open
+            self.close_data_file()
+
+            if not os.path.isfile(filepath):
+                logger.debug("Creating %s", filepath)
+
+            self.data_file = open(filepath, 'ab')
+            self.data_file_path_open = filepath
+
+        # midnight timestamp in milliseconds
+        midnight_timestamp = int(midnight.timestamp()) * 1000
+
+        lines = []
+
+        for reading in readings:
+            # reading time followed by samples
+            values = reading.list_repr()
+
+            # convert reading time to milliseconds since midnight, leaving the
+            # reading itself unchanged
+            values[0] -= midnight_timestamp
+
+            # whitespace-separated line
+            lines.append(" ".join([str(value) for value in values]) + "\n")
 
-        with open(filepath, 'a') as obj:
-            for reading in readings:
-                # midnight timestamp in milliseconds
-                midnight_timestamp = int(midnight.timestamp()) * 1000
+        # write all lines at once, bypassing the text layer since the lines
+        # only contain numbers
+        self.data_file.write("".join(lines).encode("ascii"))
 
-                # convert reading time to seconds since midnight
-                reading.reading_time = int(round(reading.reading_time -
-                                                 midnight_timestamp))
+        # make the readings available to the uploader, but keep the file open
+        # for the next batch
+        self.data_file.flush()
 
-                # write line
-                print(reading.whitespace_repr(), file=obj)
+        # bound the readings lost on power failure without syncing every batch
+        now = now_ms()
+
+        if self.last_sync_time is None \
+            or now - self.last_sync_time >= self.DATA_SYNC_INTERVAL:
+            os.fdatasync(self.data_file.fileno())
+            self.last_sync_time = now
+
+    def close_data_file(self):
+        """Closes the data file kept open for appending, if any"""
+
+        if self.data_file is not None:
+            self.data_file.flush()
+            os.fdatasync(self.data_file.fileno())
+            self.data_file.close()
+
+            self.data_file = None
+            self.data_file_path_open = None
+            self.last_sync_time = None
 
     def remove_old_files(self):
-        # number of files to keep
-        max_old_files = int(CONF["ftp"]["max_old_files"])
+        # data files, newest first
+        file_paths = self.data_file_walk()
 
-        if max_old_files < 2:
-            raise ValueError("max_old_files must be >= 2")
+        if len(file_paths) <= self.max_old_files:
+            # nothing to remove
+            return
+
+        # avoid debug logging overhead inside the loop when it's disabled
+        debug = logger.isEnabledFor(logging.DEBUG)
 
         # loop over files older than max_old_files
-        for filename in self.data_file_walk()[max_old_files:]:
-            logger.debug("Removing old local file: %s", filename)
-            os.remove(filename)
+        for filename in file_paths[self.max_old_files:]:
+            if debug:
+                logger.debug("Removing old local file: %s", filename)
+
+            try:
+                os.remove(filename)
+            except OSError as e:
+                # try again at the next clean up
+                logger.error("Failed to remove old local file %s: %s",
+                             filename, e)
 
     def data_file_walk(self, reverse=True):
-        # data directory
-        data_dir = CONF["ftp"]["local_dir"]
+        # data file extension
+        extension = os.path.extsep + self.FILE_EXTENSION
+
+        # the directory entries cache the file type, so this doesn't need a
+        # stat call per file
+        paths = [entry.path for entry in os.scandir(self.local_dir)
+                 if entry.name.endswith(extension)
+                 and not entry.name.startswith(".")
+                 and entry.is_file(follow_symlinks=False)]
 
-        return sorted(glob.glob(os.path.join(data_dir, "*.txt")), reverse=reverse)
+        paths.sort(reverse=reverse)
+
+        return paths
 
     @classmethod
     def filename_from_text(cls, base):
@@ -311,91 +510,175 @@ class FtpPipe(Thread):
 
     @classmethod
     def filename_from_date(cls, file_time):
-        return cls.filename_from_text(file_time.strftime(cls.FILE_DATE_FORMAT))
+        return cls.filename_from_text(cls.FILE_DATE_TEMPLATE.format(file_time))
 
-    @classmethod
-    def data_file_path(cls, filename):
-        return os.path.join(CONF["ftp"]["local_dir"], filename)
+    def data_file_path(self, filename):
+        return os.path.join(self.local_dir, filename)
 
-    @classmethod
-    def path_from_text(cls, base):
-        return cls.data_file_path(cls.filename_from_text(base))
+    def path_from_text(self, base):
+        return self.data_file_path(self.filename_from_text(base))
 
-    @classmethod
-    def path_from_date(cls, file_time):
-        return cls.data_file_path(cls.filename_from_date(file_time))
+    def path_from_date(self, file_time):
+        return self.data_file_path(self.filename_from_date(file_time))
 
     @classmethod
     def latest_line(cls, file_path):
         if not cls.is_valid_file_path(file_path):
             return None
 
-        last = None
+        with open(file_path, 'rb') as obj:
+            # file size
+            end = obj.seek(0, os.SEEK_END)
+
+            read_size = cls.TAIL_READ_SIZE
 
-        with open(file_path, 'r') as obj:
-            for last in [line for line in obj if line.rstrip("\n")]:
-                pass
+            # read increasingly large chunks from the end of the file until
+            # a complete non-empty line is found
+            while True:
+                start = max(0, end - read_size)
 
-        return last
+                obj.seek(start)
+                tail = obj.read(end - start).rstrip(b"\r\n")
+
+                # position of the line break preceding the last line
+                line_start = max(tail.rfind(b"\n"), tail.rfind(b"\r"))
+
+                if line_start >= 0 or start == 0:
+                    break
+
+                read_size *= 2
+
+        last = tail[line_start + 1:]
+
+        if not last:
+            return None
+
+        return last.decode()
 
     @classmethod
-    def date_file_format(cls):
-        return cls.FILE_DATE_FORMAT + os.path.extsep + cls.FILE_EXTENSION
+    def date_from_filename(cls, filename):
+        """Get the date corresponding to a data filename
+
+        This is equivalent to parsing the filename's base with
+        `FILE_DATE_FORMAT`, but slices the fixed-width date fields directly
+        instead of using the much slower `strptime`.
+
+        :param filename: data filename, without directory
+        :type filename: str
+        :return: midnight on the file's date, or None if the filename is invalid
+        :rtype: :class:`~datetime.datetime`
+        """
+
+        base, extension = os.path.splitext(filename)
+
+        if extension != os.path.extsep + cls.FILE_EXTENSION:
+            return None
+
+        # year, month and day fields of FILE_DATE_FORMAT
+        fields = (base[0:4], base[5:7], base[8:10])
+
+        if len(base) != 10 or base[4] != "-" or base[7] != "-" \
+            or not all(field.isdigit() for field in fields):
+            return None
+
+        try:
+            return datetime.datetime(*[int(field) for field in fields])
+        except ValueError:
+            return None
 
     @classmethod
     def is_valid_file_path(cls, file_path):
         base_file_path = os.path.basename(file_path)
 
-        try:
-            datetime.datetime.strptime(base_file_path, cls.date_file_format())
-        except ValueError:
-            return False
+        return cls.date_from_filename(base_file_path) is not None
 
-        return True
+    @classmethod
+    def reading_day(cls, reading):
+        """Get the number of whole UTC days between the epoch and a reading
 
-    @staticmethod
-    def midnight_date(date_now):
-        return date_now.replace(hour=0, minute=0, second=0, microsecond=0)
+        :param reading: reading
+        :type reading: :class:`~datalog.data.Reading`
+        :return: day number
+        :rtype: int
+        """
+
+        return reading.reading_time // cls.MS_PER_DAY
 
     @staticmethod
-    def after_url(pivot_timestamp):
-        return "http://%s:%i/after/%i?fmt=json" % (CONF["server"]["host"],
-                                                   int(CONF["server"]["port"]),
-                                                   pivot_timestamp)
+    def after_path(pivot_timestamp):
+        return "/after/%i?fmt=json" % pivot_timestamp
 
-    @classmethod
-    def next_readings(cls, pivot_timestamp):
-        # reading url
-        url = cls.after_url(pivot_timestamp)
+    def server_get(self, path):
+        """Send a GET request to the magnetometer server
 
-        logger.debug("Fetching readings from %s", url)
+        The connection is kept open between requests, so if the server has
+        since closed it the request is retried once on a new connection. A
+        gzip-compressed response is requested.
 
-        # timeout
-        timeout = float(CONF["server"]["timeout"])
+        :param path: request path
+        :type path: str
+        :return: server response
+        :rtype: :class:`http.client.HTTPResponse`
+        """
+
+        headers = {"Accept-Encoding": "gzip"}
+
+        try:
+            self.server_connection.request("GET", path, headers=headers)
+            return self.server_connection.getresponse()
+        except ConnectionError:
+            self.server_connection.close()
+
+        self.server_connection.request("GET", path, headers=headers)
+        return self.server_connection.getresponse()
+
+    def next_readings(self, pivot_timestamp):
+        # reading path
+        path = self.after_path(pivot_timestamp)
+
+        logger.debug("Fetching readings from %s:%i%s",
+                     self.server_connection.host, self.server_connection.port,
+                     path)
 
         try:
             # fetch JSON document
-            with urlopen(url, timeout=timeout) as response:
-                # response encoding
-                charset = response.headers.get_content_charset()
+            response = self.server_get(path)
+
+            if response.status != 200:
+                raise HTTPException("HTTP %i: %s" % (response.status,
+                                                     response.reason))
 
-                # decode document
-                document = response.read().decode(charset)
+            # response encoding
+            charset = response.headers.get_content_charset("utf-8")
 
-                # try to parse JSON
-                try:
-                    datastore = DataStore.instance_from_json(document)
+            if response.getheader("Content-Encoding") == "gzip":
+                # decompress the response as it's read
+                document = gzip.GzipFile(fileobj=response)
+            else:
+                document = response
+
+            # try to parse JSON
+            try:
+                data = json.loads(document.read().decode(charset))
 
-                    logger.info("Found %i new readings",
-                                datastore.num_readings)
-                except Exception as e:
-                    logger.error(e)
+                datastore = DataStore(len(data))
+                datastore.insert_from_dict_list(data)
 
-                    # return empty dataset
-                    datastore = DataStore()
+                logger.info("Found %i new readings", datastore.num_readings)
+            except Exception as e:
+                logger.error(e)
+
+                # the response may not have been fully read
+                self.server_connection.close()
+
+                # return empty dataset
+                datastore = DataStore()
         except Exception as e:
             logger.error("Cannot open URL: %s", e)
 
+            # start again with a new connection
+            self.server_connection.close()
+
             # return empty dataset
             datastore = DataStore()
 
@@ -1,17 +1,20 @@
 """University of Glasgow magnetometer run script"""
 
+import os
 import sys
 import time
+import gzip
+import json
 import logging
 from logging.handlers import TimedRotatingFileHandler
-from bottle import Bottle, request, run, abort
+import datalog
+from bottle import Bottle, request, response, run, abort
 from datalog.adc.config import AdcConfig
 from datalog.adc.adc import Adc
 from datalog.data import DataStore
 
 from .config import MagnetometerConfig
-from .calibration import set_conversion, scale_counts_to_volts, \
-                         scale_volts_to_nt_and_degrees
+from .calibration import set_conversion, scale_counts_to_nt_and_degrees
 
 # create root logger
 root_logger = logging.getLogger()
@@ -44,17 +47,30 @@ def run():
     runner.run()
 
 class MagnetometerRunner(object):
+    # maximum number of formatted responses to keep for one datastore state
+    MAX_CACHED_RESPONSES = 100
+
+    # smallest response body worth compressing, in bytes
+    MIN_COMPRESS_SIZE = 1024
+
     def __init__(self):
         # create ADC device
         self.adc = Adc.load_from_config(AdcConfig())
 
         # create datastore with conversion to nT
         self.datastore = DataStore(CONF["datastore"]["size"],
-            conversion_callbacks=[scale_counts_to_volts,
-                                  scale_volts_to_nt_and_degrees])
+            conversion_callbacks=[scale_counts_to_nt_and_degrees])
 
-        # start time
+        # start time, as wall clock and monotonic clock readings
         self.start_time = None
+        self.start_monotonic = None
+
+        # formatted server info that doesn't change while running
+        self.info_prefix = None
+
+        # datastore state and the formatted responses for it, kept together so
+        # concurrent requests can swap them atomically
+        self.response_cache = (None, {})
 
         # create web app and routes
         self.app = Bottle()
@@ -63,9 +79,24 @@ class MagnetometerRunner(object):
     def run(self):
         host = str(CONF["server"]["host"])
         port = int(CONF["server"]["port"])
+        backend = CONF["server"].get("backend", "wsgiref")
+
+        # CPUs available before pinning, for the web server if it isn't pinned
+        try:
+            default_cpus = os.sched_getaffinity(0)
+        except AttributeError:
+            default_cpus = None
+
+        # the retriever thread inherits the CPU affinity of this thread
+        retriever_pinned = self.set_cpu_affinity("retriever_cpus")
 
         # get retriever and FTP contexts
         with self.adc.get_retriever(self.datastore) as retriever:
+            # move this thread, and so the web server, to its own CPUs, or back
+            # to the original ones if only the retriever is pinned
+            self.set_cpu_affinity("server_cpus",
+                                  default_cpus if retriever_pinned else None)
+
             # set conversion factors
             set_conversion([self.adc.get_calibration(channel) for channel
                             in sorted(self.adc.enabled_channels)])
@@ -74,9 +105,49 @@ class MagnetometerRunner(object):
 
             # set start time
             self.start_time = int(round(time.time() * 1000))
+            self.start_monotonic = time.monotonic()
+
+            # format static server info once
+            self.info_prefix = self.format_info_prefix()
+
+            logger.info("Starting web server using %s", backend)
+            self.app.run(server=backend, host=host, port=port)
+
+    def set_cpu_affinity(self, key, default_cpus=None):
+        """Pin the calling thread, and any threads it later creates, to the \
+        CPUs listed in the specified server config key
+
+        :param key: config key holding a comma separated list of CPU numbers
+        :type key: string
+        :param default_cpus: CPU numbers to use if the key is not set, or None \
+        to leave the affinity unchanged
+        :type default_cpus: set
+        :return: whether the affinity was changed
+        :rtype: bool
+        """
+
+        value = CONF["server"].get(key)
+
+        try:
+            if value:
+                cpus = [int(cpu) for cpu in value.split(",")]
+            elif default_cpus is not None:
+                cpus = default_cpus
+            else:
+                return False
+
+            os.sched_setaffinity(0, cpus)
+        except AttributeError:
+            logger.warning("CPU affinity is not supported on this platform")
+        except (ValueError, OSError) as e:
+            logger.error("Cannot set CPU affinity for %s: %s", key, e)
+        else:
+            logger.debug("Set CPU affinity for %s to %s", key,
+                         ",".join([str(cpu) for cpu in sorted(cpus)]))
+
+            return True
 
-            logger.info("Starting web server")
-            self.app.run(host=host, port=port)
+        return False
 
     def create_routes(self):
         self.app.route("/earliest", method="GET", callback=self.earliest)
@@ -137,7 +208,7 @@ class MagnetometerRunner(object):
         except TypeError:
             abort(400, "Invalid parameter")
 
-    def info():
+    def info(self):
         """Get server info
 
         :return: formatted server info
@@ -146,22 +217,38 @@ class MagnetometerRunner(object):
 
         fmt = request.query.get("fmt", default=CONF["server"]["default_format"])
 
+        if fmt not in self.info_prefix:
+            abort(400, "Invalid format")
+
+        prefix = self.info_prefix[fmt]
+
         # uptime
-        up_time = int(round(time.time() * 1000)) - self.start_time
+        up_time = int(round((time.monotonic() - self.start_monotonic) * 1000))
+
+        if fmt == "json":
+            return "{}, \"up_time\": {}}}".format(prefix, up_time)
+        else:
+            return "{}\n\"up_time\",\"{}\"".format(prefix, up_time)
+
+    def format_info_prefix(self):
+        """Format the server info that stays fixed while the server runs
+
+        The JSON prefix is left unterminated so the uptime can be appended.
+
+        :return: formatted static info for each format
+        :rtype: dict
+        """
 
         data = {
             "datalog_version": datalog.__version__,
-            "start_time": self.start_time,
-            "up_time": up_time
+            "start_time": self.start_time
         }
 
-        if fmt == "json":
-            return json.dumps(data)
-        elif fmt == "csv":
-            return "\n".join(["\"{}\",\"{}\"".format(key, val)
-                              for key, val in data.items()])
-        else:
-            abort(400, "Invalid format")
+        return {
+            "json": json.dumps(data, sort_keys=True)[:-1],
+            "csv": "\n".join(["\"{}\",\"{}\"".format(key, val)
+                              for key, val in sorted(data.items())])
+        }
 
     def handle_fixed_list(self, fmt, *args, **kwargs):
         """Generate a string representation of the data given specified filters
@@ -173,12 +260,91 @@ class MagnetometerRunner(object):
         """
 
         if fmt == "json":
-            return self.datastore.json_repr(*args, **kwargs)
+            formatter = self.datastore.json_repr
         elif fmt == "csv":
-            return self.datastore.csv_repr(*args, **kwargs)
+            formatter = self.datastore.csv_repr
         else:
             abort(400, "Invalid format")
 
+        # discard cached responses once new readings have arrived
+        state = self.datastore_state()
+        cache_state, cache = self.response_cache
+
+        if state != cache_state or len(cache) >= self.MAX_CACHED_RESPONSES:
+            cache = {}
+            self.response_cache = (state, cache)
+
+        compress = self.accepts_gzip()
+        key = (fmt, compress, args, tuple(sorted(kwargs.items())))
+
+        body = cache.get(key)
+
+        if body is None:
+            body = formatter(*args, **kwargs)
+
+            if compress and len(body) >= self.MIN_COMPRESS_SIZE:
+                body = gzip.compress(body.encode("utf-8"), 1)
+
+            cache[key] = body
+
+        response.set_header("Vary", "Accept-Encoding")
+
+        if isinstance(body, bytes):
+            response.set_header("Content-Encoding", "gzip")
+
+        return body
+
+    def accepts_gzip(self):
+        """Check if the client accepts gzip encoded responses
+
+        Codings listed with a quality value of zero are refused, and a `*`
+        entry applies to gzip if gzip isn't listed itself.
+
+        :return: whether the request's Accept-Encoding header allows gzip
+        :rtype: bool
+        """
+
+        encodings = request.headers.get("Accept-Encoding", "")
+
+        # quality values of the listed codings
+        qualities = {}
+
+        for encoding in encodings.split(","):
+            name, _, params = encoding.partition(";")
+            quality = 1.0
+
+            for param in params.split(";"):
+                key, _, value = param.partition("=")
+
+                if key.strip().lower() == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        # treat an invalid quality as a refusal
+                        quality = 0
+
+            qualities[name.strip().lower()] = quality
+
+        quality = qualities.get("gzip", qualities.get("x-gzip",
+                                                      qualities.get("*", 0)))
+
+        return quality > 0
+
+    def datastore_state(self):
+        """Get a value that changes whenever readings are added to the \
+        datastore
+
+        :return: number of readings and time of the latest reading
+        :rtype: tuple
+        """
+
+        try:
+            latest_time = self.datastore.readings[-1].reading_time
+        except IndexError:
+            latest_time = None
+
+        return self.datastore.num_readings, latest_time
+
     def data_query_args(self):
         """Extract query arguments
 
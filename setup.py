@@ -1,10 +1,8 @@
 #!/usr/bin/env python3
 
 from setuptools import setup
-import platform
 
 import magnetometer
-from magnetometer.config import BaseConfig
 
 with open("README.md") as readme_file:
     readme = readme_file.read()
@@ -16,19 +14,43 @@ requirements = [
     "appdirs",
     "datalog",
     "bottle",
+    "numpy",
     "pyftpsync==2.0.0"
 ]
 
 # data files
 data_files = []
 
+def linux_distribution():
+    """Get the Linux distribution ID and version from /etc/os-release
+
+    :return: distribution ID and version
+    :rtype: tuple
+    """
+
+    release = {}
+
+    try:
+        with open("/etc/os-release") as release_file:
+            for line in release_file:
+                key, _, value = line.strip().partition("=")
+                release[key] = value.strip("\"'")
+    except OSError:
+        pass
+
+    try:
+        version = float(release.get("VERSION_ID", ""))
+    except ValueError:
+        version = 0
+
+    return release.get("ID", ""), version
+
 # operating system
-distro_name = platform.dist()[0]
-distro_version = float(platform.dist()[1])
+distro_name, distro_version = linux_distribution()
 
 # add systemd service files if supported
-if (distro_name == "debian" and distro_version >= 7.0) or (
-    distro_name == "Ubuntu" and distro_version >= 16.04):
+if (distro_name in ("debian", "raspbian") and distro_version >= 7.0) or (
+    distro_name == "ubuntu" and distro_version >= 16.04):
         # add systemd service files
         data_files.append(('/etc/systemd/system',
                            ['magnetometer-server.service',
@@ -58,6 +80,7 @@ setup(
         ]
     },
     install_requires=requirements,
+    python_requires=">=3.5",
     license="GPLv3",
     zip_safe=False,
     classifiers=[